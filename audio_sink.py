@@ -0,0 +1,144 @@
+import os
+import time
+import wave
+import logging
+import threading
+import numpy
+
+import metrics
+import resample
+
+logger = logging.getLogger("klab")
+
+# 出力先からサンプリング周波数が分からない場合に使う値
+DEFAULT_RATE = 48000
+
+# 音声の出力先です
+# play() は再生が終わるまで戻りません (実時間で再生しない出力先は即座に戻ります)
+class AudioSink():
+    def play(self, wav, fs):
+        raise NotImplementedError()
+
+    # 発話の間の無音時間です
+    def wait(self, sec):
+        pass
+
+    # 変換なしで再生できるサンプリング周波数です
+    def native_rate(self):
+        return DEFAULT_RATE
+
+# サウンドデバイスで再生します
+# デバイスの周波数は最初の再生時に1回だけ問い合わせ、違う場合は変換してから再生します
+# 変換は再生のたびに行われるので、main.OUTPUT_FS はデバイスの周波数に合わせてください
+class SoundDeviceSink(AudioSink):
+    def __init__(self):
+        # オーディオデバイスが無い環境でも import できるように遅延 import
+        import sounddevice
+        self._sd = sounddevice
+        self._rate = None
+        self._warned = False
+
+    def play(self, wav, fs):
+        rate = self.native_rate()
+        if fs != rate:
+            if not self._warned:
+                self._warned = True
+                logger.warning('event=device_rate_mismatch clip_fs=%d device_fs=%d hint="set OUTPUT_FS to %d"', fs, rate, rate)
+            with metrics.timed("klab_resample_seconds", stage="play"):
+                wav = resample.resample(wav, fs, rate)
+            fs = rate
+        self._sd.play(wav, fs)
+        # 次の play() は前のストリームを止めるので、最後まで出力されるのを待つ
+        self._sd.wait()
+
+    def wait(self, sec):
+        time.sleep(sec)
+
+    def native_rate(self):
+        if self._rate is None:
+            self._rate = int(self._sd.query_devices(kind='output')['default_samplerate'])
+        return self._rate
+
+# 何もせずに即座に戻ります (負荷試験用)
+class NullSink(AudioSink):
+    def __init__(self):
+        self.count = 0
+        self.samples = 0
+
+    def play(self, wav, fs):
+        self.count += 1
+        self.samples += len(wav)
+
+# 再生する代わりに連番のWAVファイルに書き出します
+class WavFileSink(AudioSink):
+    def __init__(self, dir = 'sink_output'):
+        self._dir = dir
+        self._index = 0
+        self._lock = threading.Lock()
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+
+    def play(self, wav, fs):
+        with self._lock:
+            self._index += 1
+            path = os.path.join(self._dir, '%06d.wav' % self._index)
+        with wave.open(path, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(fs)
+            w.writeframes(numpy.asarray(wav, dtype=numpy.int16).tobytes())
+
+# 直近 seconds 秒分の音声をメモリ上のリングバッファに保持します
+# fs と違う周波数の音声は変換してから保持します
+class RingBufferSink(AudioSink):
+    def __init__(self, seconds = 60, fs = DEFAULT_RATE):
+        self.fs = fs
+        self.count = 0
+        self._buf = numpy.zeros(int(seconds * fs), dtype=numpy.int16)
+        self._pos = 0
+        self._filled = 0
+        self._lock = threading.Lock()
+
+    def play(self, wav, fs):
+        wav = numpy.asarray(wav, dtype=numpy.int16)
+        if fs != self.fs:
+            wav = resample.resample(wav, fs, self.fs)
+        size = len(self._buf)
+        with self._lock:
+            self.count += 1
+            if len(wav) >= size:
+                self._buf[:] = wav[-size:]
+                self._pos = 0
+                self._filled = size
+                return
+            end = self._pos + len(wav)
+            if end <= size:
+                self._buf[self._pos:end] = wav
+            else:
+                first = size - self._pos
+                self._buf[self._pos:] = wav[:first]
+                self._buf[:end - size] = wav[first:]
+            self._pos = end % size
+            self._filled = min(size, self._filled + len(wav))
+
+    def native_rate(self):
+        return self.fs
+
+    # 保持している音声を古い順に返します
+    def read(self):
+        with self._lock:
+            if self._filled < len(self._buf):
+                return self._buf[:self._filled].copy()
+            return numpy.concatenate([self._buf[self._pos:], self._buf[:self._pos]])
+
+SINKS = {
+    'sounddevice': SoundDeviceSink,
+    'null': NullSink,
+    'wav': WavFileSink,
+    'ring': RingBufferSink,
+}
+
+def make_sink(name, **kwargs):
+    if name not in SINKS:
+        raise ValueError('unknown audio sink: %s' % name)
+    return SINKS[name](**kwargs)
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import datetime
+import tempfile
+import statistics
+
+import main
+import metrics
+import audio_sink
+import clip_cache
+from bench import workload
+from bench.stub_db import SqliteDatabase
+from bench.stub_voicevox import StubVoiceVox
+
+# リポジトリ直下で python -m bench を実行すると各段の処理時間を計測して表にします
+# --save で結果を保存し、--compare で保存した結果と比較します
+
+class _FirstAudioSink(audio_sink.NullSink):
+    def __init__(self):
+        super().__init__()
+        self.first = None
+        self.last = None
+
+    def play(self, wav, fs):
+        if self.first is None:
+            self.first = time.perf_counter()
+        self.last = time.perf_counter()
+        super().play(wav, fs)
+
+def _summary(samples):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(round(len(samples) * 0.95)) - 1)]
+    return {"median_ms": statistics.median(samples) * 1000, "p95_ms": p95 * 1000, "n": len(samples)}
+
+def _measure(func, repeat):
+    ret = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        ret.append(time.perf_counter() - start)
+    return ret
+
+def _purge_cache():
+    main.VoiceVox().cache_purge()
+
+def bench_poll(results, workdir, repeat):
+    today = datetime.datetime.now()
+    for (people, taps) in [(10, 2), (20, 10), (50, 40)]:
+        db = SqliteDatabase(os.path.join(workdir, 'poll_%d_%d.sqlite' % (people, taps)))
+        names = ['Person %03d' % i for i in range(people)]
+        for (i, name) in enumerate(names):
+            db.add_person(name, priority=i)
+        db.add_taps(workload.uniform_day(names, taps, today))
+        k = main.klab(debug=True, database=db)
+        k.check()
+        results['poll/people=%d,taps=%d' % (people, taps)] = _summary(_measure(k.check, repeat))
+
+    # 朝の集中、日中の出入り、夕方の集中を含む1日分
+    people = 50
+    db = SqliteDatabase(os.path.join(workdir, 'poll_lab_day.sqlite'))
+    names = ['Person %03d' % i for i in range(people)]
+    for (i, name) in enumerate(names):
+        db.add_person(name, priority=i)
+    db.add_taps(workload.lab_day(names, today))
+    k = main.klab(debug=True, database=db)
+    k.check()
+    results['poll/lab_day,people=%d' % people] = _summary(_measure(k.check, repeat))
+
+# cache/hit は共有キャッシュ (ディレクトリか HTTP) から読んだ時間で、メモリとローカルは別に計ります
+# 層ごとに新しい ClipCache を使い、手前の層に残った分で速く見えないようにします
+def bench_cache(results, workdir, repeat):
+    ai = main.VoiceVox()
+    _purge_cache()
+    texts = ['ミス%d' % i for i in range(repeat)]
+    measure = lambda: _summary([_measure(lambda t=t: ai.generate_wav(t), 1)[0] for t in texts])
+    results['cache/miss'] = measure()
+    saved = main._clip_cache
+    try:
+        main._clip_cache = clip_cache.ClipCache(main.make_shared_store())
+        results['cache/hit'] = measure()
+        results['cache/hit_memory'] = measure()
+        local = clip_cache.DirStore(os.path.join(workdir, 'local_cache'))
+        # 1回目で共有キャッシュからローカルに写し、新しい ClipCache でローカルから読む
+        main._clip_cache = clip_cache.ClipCache(main.make_shared_store(), local)
+        measure()
+        main._clip_cache = clip_cache.ClipCache(main.make_shared_store(), local)
+        results['cache/hit_local'] = measure()
+    finally:
+        main._clip_cache = saved
+
+def bench_warmup(results, repeat):
+    cold = []
+    for _ in range(max(1, repeat // 10)):
+        _purge_cache()
+        cold += _measure(main.PrepareEssential, 1)
+    results['warmup/cold'] = _summary(cold)
+    results['warmup/warm'] = _summary(_measure(main.PrepareEssential, max(1, repeat // 10)))
+
+def bench_tap_to_audio(results, workdir, repeat):
+    db = SqliteDatabase(os.path.join(workdir, 'tap.sqlite'))
+    for (i, name) in enumerate(main.NAME_LIST):
+        db.add_person(name, priority=i)
+
+    for label in ['cold', 'warm']:
+        samples = []
+        for _ in range(repeat):
+            if label == 'cold':
+                _purge_cache()
+            else:
+                main.PrepareEssential()
+            db.clear_taps()
+            k = main.klab(debug=True, database=db)
+            sink = _FirstAudioSink()
+            main.set_sink(sink)
+            start = time.perf_counter()
+            db.add_tap('Makoto Kuno', datetime.datetime.now())
+            (enter, exit) = k.check()
+            main.Announce(enter, exit, start)
+            samples.append(sink.first - start)
+        results['tap_to_first_audio/%s' % label] = _summary(samples)
+
+    # 全員がほぼ同時に入室した時に最後の人のアナウンスが始まるまで
+    # 朝の集中の並びを保ったまま、起動後の1回のチェックで全員が見つかるように時刻をずらす
+    for label in ['cold', 'warm']:
+        samples = []
+        for _ in range(repeat):
+            if label == 'cold':
+                _purge_cache()
+            else:
+                main.PrepareEssential()
+            db.clear_taps()
+            k = main.klab(debug=True, database=db)
+            sink = _FirstAudioSink()
+            main.set_sink(sink)
+            now = datetime.datetime.now().replace(microsecond=0)
+            taps = workload.morning_burst(main.NAME_LIST, now, spread_min=0.5)
+            offset = now - min(dt for (_, dt) in taps).replace(microsecond=0)
+            start = time.perf_counter()
+            db.add_taps([(name, dt + offset) for (name, dt) in taps])
+            (enter, exit) = k.check()
+            main.Announce(enter, exit, start)
+            samples.append(sink.last - start)
+        results['burst_to_last_audio/%s' % label] = _summary(samples)
+
+def print_report(results, baseline = None):
+    header = '%-32s %10s %10s %6s' % ('benchmark', 'median_ms', 'p95_ms', 'n')
+    if baseline:
+        header += ' %12s %8s' % ('base_median', 'delta')
+    print(header)
+    print('-' * len(header))
+    for name in sorted(results):
+        r = results[name]
+        line = '%-32s %10.2f %10.2f %6d' % (name, r["median_ms"], r["p95_ms"], r["n"])
+        if baseline and name in baseline:
+            base = baseline[name]["median_ms"]
+            delta = (r["median_ms"] - base) / base * 100 if base else 0.0
+            line += ' %12.2f %+7.1f%%' % (base, delta)
+        print(line)
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='klab_bench_')
+    cwd = os.getcwd()
+    stub = StubVoiceVox(latency=args.latency, payload_sec=args.payload_sec).start()
+    main.VOICEVOX_HOST = stub.host
+    main.VOICEVOX_PORT = stub.port
+    main.set_sink('null')
+    results = {}
+    try:
+        # キャッシュはカレントディレクトリに作られるので作業ディレクトリに移動
+        os.chdir(workdir)
+        metrics.reset()
+        bench_poll(results, workdir, args.repeat)
+        bench_cache(results, workdir, args.repeat)
+        bench_warmup(results, args.repeat)
+        bench_tap_to_audio(results, workdir, max(1, args.repeat // 5))
+    finally:
+        os.chdir(cwd)
+        stub.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m bench')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05, help='stub engine latency per request [s]')
+    parser.add_argument('--payload-sec', type=float, default=1.0, help='length of synthesized audio [s]')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--compare', help='compare against results saved with --save')
+    args = parser.parse_args()
+
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)["results"]
+    print_report(results, baseline)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({"params": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
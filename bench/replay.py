@@ -0,0 +1,214 @@
+import json
+import time
+import argparse
+import datetime
+import statistics
+
+import main
+import metrics
+import audio_sink
+
+# 記録された1日分のタッチを時間を縮めて klab → アナウンス → 出力先 に流します
+# 例: python -m bench.replay --date 2024-04-08 --speed 60
+#     python -m bench.replay --file day.json --speed 60 --sink null
+
+_DT_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# 指定日のタッチ記録をデータベースから読み込みます
+# 返り値は get_today_list() と同じ {name: ['YYYY-mm-dd HH:MM:SS', ...]} です
+def load_day(day, database = None):
+    db = database if database is not None else main.Database()
+    day = day.replace(hour=0, minute=0, second=0, microsecond=0)
+    tomorrow = day + datetime.timedelta(days=1)
+    ret = {}
+    for name in db.get_name_list():
+        dict = db.get_datetime_list(name, day.strftime("%Y%m%d"), tomorrow.strftime("%Y%m%d"))
+        ret[name] = [dt.strftime(_DT_FORMAT) for dt in dict["datetime"]]
+    return ret
+
+def load_file(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def export_file(day_list, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(day_list, f, ensure_ascii=False, indent=2)
+
+# 実時間を speed 倍した仮想時計です
+class VirtualClock():
+    def __init__(self, start, speed):
+        self.start = start
+        self.speed = speed
+        self._t0 = time.perf_counter()
+
+    def now(self):
+        return self.start + datetime.timedelta(seconds=(time.perf_counter() - self._t0) * self.speed)
+
+    def sleep(self, sec):
+        time.sleep(sec / self.speed)
+
+# 仮想時刻までのタッチだけを返す klab です
+class ReplayKlab(main.klab):
+    def __init__(self, day_list, clock):
+        self._clock = clock
+        self._day_list = {}
+        for (name, items) in day_list.items():
+            self._day_list[name] = sorted(datetime.datetime.strptime(item, _DT_FORMAT) for item in items)
+        super().__init__(debug=True, database=main.Database())
+        self._replay_since = clock.start
+
+    def _now(self):
+        return self._clock.now()
+
+    def _get_json(self):
+        now = self._now()
+        ret = {}
+        for (name, items) in self._day_list.items():
+            ret[name] = [dt.strftime(_DT_FORMAT) for dt in items if dt <= now]
+        return ret
+
+    # 検出したイベントの元になったタッチ時刻を返します
+    def event_time(self, name, kind):
+        (enter, exit) = self._find_enter_exit_time(self._get_json()[name])
+        return enter if kind == 'enter' else exit
+
+# 仮想時計で動く出力先です
+# inner が None の場合は音声の長さだけ仮想時間を進めます
+class VirtualSink(audio_sink.AudioSink):
+    def __init__(self, clock, inner = None):
+        self._clock = clock
+        self._inner = inner
+
+    def play(self, wav, fs):
+        if self._inner is None:
+            self._clock.sleep(len(wav)/fs)
+        else:
+            self._inner.play(wav, fs)
+
+    def wait(self, sec):
+        if self._inner is None:
+            self._clock.sleep(sec)
+        else:
+            self._inner.wait(sec)
+
+    def native_rate(self):
+        if self._inner is None:
+            return super().native_rate()
+        return self._inner.native_rate()
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(len(values) * p)) - 1))]
+
+# render が True なら本番と同じく「名前 + 挨拶」を事前に作成してから始めます
+def replay(day_list, speed = 60.0, sink = None, start = None, end = None, poll_sec = 1.0, render = True):
+    times = sorted(datetime.datetime.strptime(item, _DT_FORMAT) for items in day_list.values() for item in items)
+    if not times:
+        raise ValueError('no taps to replay')
+    if start is None:
+        start = times[0] - datetime.timedelta(minutes=1)
+    if end is None:
+        end = times[-1] + datetime.timedelta(minutes=5)
+
+    if render:
+        main.RenderAnnouncements(list(day_list.keys()))
+
+    clock = VirtualClock(start, speed)
+    main.set_sink(VirtualSink(clock, sink))
+    k = ReplayKlab(day_list, clock)
+    engine = main.VoiceVox()._ai_name()
+    hits = metrics.get_counter("klab_cache_hits_total", engine=engine)
+    misses = metrics.get_counter("klab_cache_misses_total", engine=engine)
+    composite_hits = metrics.get_counter("klab_composite_hits_total", engine=engine)
+    composite_misses = metrics.get_counter("klab_composite_misses_total", engine=engine)
+
+    depths = []
+    delays = []
+    events = []
+    while clock.now() < end:
+        (enter, exit) = k.check()
+        num_event = len(enter) + len(exit)
+        if num_event < 1:
+            clock.sleep(poll_sec)
+            continue
+        detected = clock.now()
+        depths.append(num_event)
+        tapped = [(name, 'enter', k.event_time(name, 'enter')) for name in enter]
+        tapped += [(name, 'exit', k.event_time(name, 'exit')) for name in exit]
+        # 1つのアナウンスが複数回に分けて再生されることがあるので、各アナウンスの最初の再生時刻を記録する
+        spoken_at = {}
+        def on_audio(name, kind):
+            spoken_at[(name, kind)] = clock.now()
+        main.Announce(enter, exit, time.perf_counter(), on_audio, detected)
+        for (name, kind, dt) in tapped:
+            spoken = spoken_at.get((name, kind))
+            if spoken is None:
+                continue
+            delays.append((spoken - dt).total_seconds())
+            events.append({"name": name, "kind": kind, "tap": dt.strftime(_DT_FORMAT), "detected": detected.strftime(_DT_FORMAT), "spoken": spoken.strftime(_DT_FORMAT)})
+
+    report = {}
+    report["start"] = start.strftime(_DT_FORMAT)
+    report["end"] = end.strftime(_DT_FORMAT)
+    report["speed"] = speed
+    report["events"] = len(delays)
+    report["polls_with_events"] = len(depths)
+    report["queue_depth_max"] = max(depths) if depths else 0
+    report["queue_depth_mean"] = statistics.mean(depths) if depths else 0.0
+    if delays:
+        report["delay_median_sec"] = statistics.median(delays)
+        report["delay_p95_sec"] = _percentile(delays, 0.95)
+        report["delay_max_sec"] = max(delays)
+    # 事前に作成した「名前 + 挨拶」はクリップのキャッシュを通らないので別に数える
+    report["composite_hits"] = metrics.get_counter("klab_composite_hits_total", engine=engine) - composite_hits
+    report["composite_misses"] = metrics.get_counter("klab_composite_misses_total", engine=engine) - composite_misses
+    report["cache_hits"] = metrics.get_counter("klab_cache_hits_total", engine=engine) - hits
+    report["cache_misses"] = metrics.get_counter("klab_cache_misses_total", engine=engine) - misses
+    report["log"] = events
+    return report
+
+def print_report(report):
+    for key in ['start', 'end', 'speed', 'events', 'polls_with_events', 'queue_depth_max', 'queue_depth_mean',
+                'delay_median_sec', 'delay_p95_sec', 'delay_max_sec', 'composite_hits', 'composite_misses',
+                'cache_hits', 'cache_misses']:
+        if key in report:
+            value = report[key]
+            if isinstance(value, float):
+                value = '%.2f' % value
+            print('%-20s %s' % (key, value))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m bench.replay')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--date', help='replay this day from the database (YYYY-MM-DD)')
+    source.add_argument('--file', help='replay a day exported with --export')
+    parser.add_argument('--export', help='write the loaded day to this JSON file and exit')
+    parser.add_argument('--speed', type=float, default=60.0)
+    parser.add_argument('--sink', choices=['simulated'] + sorted(audio_sink.SINKS), default='simulated',
+                        help='simulated advances virtual time by the clip length without playing it')
+    parser.add_argument('--start', help='virtual start time (HH:MM)')
+    parser.add_argument('--end', help='virtual end time (HH:MM)')
+    parser.add_argument('--log', help='write per-event timings to this JSON file')
+    parser.add_argument('--no-render', action='store_true', help='do not pre-render name + greeting clips before replaying')
+    args = parser.parse_args()
+
+    if args.date:
+        day_list = load_day(datetime.datetime.strptime(args.date, '%Y-%m-%d'))
+    else:
+        day_list = load_file(args.file)
+    if args.export:
+        export_file(day_list, args.export)
+        raise SystemExit(0)
+
+    day = min(datetime.datetime.strptime(item, _DT_FORMAT) for items in day_list.values() for item in items)
+    start = end = None
+    if args.start:
+        start = datetime.datetime.combine(day.date(), datetime.datetime.strptime(args.start, '%H:%M').time())
+    if args.end:
+        end = datetime.datetime.combine(day.date(), datetime.datetime.strptime(args.end, '%H:%M').time())
+
+    sink = None if args.sink == 'simulated' else audio_sink.make_sink(args.sink)
+    report = replay(day_list, args.speed, sink, start, end, render=not args.no_render)
+    print_report(report)
+    if args.log:
+        export_file(report["log"], args.log)
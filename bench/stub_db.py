@@ -0,0 +1,57 @@
+import zlib
+import sqlite3
+import datetime
+import main
+
+# idm_datetime / idm_name テーブルを SQLite で再現した Database です
+# 日時は 'YYYYMMDDHHMMSS' の文字列で保存するので
+# main.Database の BETWEEN '20240101' AND '20240102' の問い合わせがそのまま使えます
+# (型名に TEXT を含めて数値として保存されないようにしています)
+_DT_FORMAT = '%Y%m%d%H%M%S'
+
+sqlite3.register_converter("DATETEXT", lambda b: datetime.datetime.strptime(b.decode(), _DT_FORMAT))
+
+class SqliteDatabase(main.Database):
+    def __init__(self, path):
+        self._path = path
+        con = sqlite3.connect(path)
+        try:
+            con.execute("CREATE TABLE IF NOT EXISTS idm_name (idm TEXT PRIMARY KEY, name TEXT, enable INTEGER DEFAULT 1, priority INTEGER DEFAULT 0)")
+            con.execute("CREATE TABLE IF NOT EXISTS idm_datetime (idm TEXT, `datetime` DATETEXT)")
+            con.execute("CREATE INDEX IF NOT EXISTS idm_datetime_dt ON idm_datetime (`datetime`)")
+            con.commit()
+        finally:
+            con.close()
+
+    def _get_mariadb_con(self):
+        return sqlite3.connect(self._path, detect_types=sqlite3.PARSE_DECLTYPES)
+
+    def _idm(self, name):
+        return 'idm-%08x' % zlib.crc32(name.encode("utf-8"))
+
+    def add_person(self, name, priority = 0, enable = 1):
+        con = sqlite3.connect(self._path)
+        try:
+            con.execute("INSERT OR REPLACE INTO idm_name VALUES (?, ?, ?, ?)", (self._idm(name), name, enable, priority))
+            con.commit()
+        finally:
+            con.close()
+
+    def add_taps(self, taps):
+        con = sqlite3.connect(self._path)
+        try:
+            con.executemany("INSERT INTO idm_datetime VALUES (?, ?)", [(self._idm(name), dt.strftime(_DT_FORMAT)) for (name, dt) in taps])
+            con.commit()
+        finally:
+            con.close()
+
+    def add_tap(self, name, dt):
+        self.add_taps([(name, dt)])
+
+    def clear_taps(self):
+        con = sqlite3.connect(self._path)
+        try:
+            con.execute("DELETE FROM idm_datetime")
+            con.commit()
+        finally:
+            con.close()
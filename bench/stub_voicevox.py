@@ -0,0 +1,95 @@
+import io
+import json
+import time
+import wave
+import numpy
+import threading
+import http.server
+import urllib.parse
+
+# VoiceVox エンジンの代わりに応答するスタブサーバです
+# latency は各エンドポイントの応答遅延 (秒)、payload_sec は返す音声の長さ (秒) です
+class StubVoiceVox():
+    def __init__(self, latency = 0.0, payload_sec = 1.0, fs = 24000, host = '127.0.0.1', port = 0):
+        self.latency = latency
+        self.payload_sec = payload_sec
+        self.fs = fs
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer((host, port), self._make_handler())
+        self.host = host
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    def _count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def _make_wav(self, text):
+        n = int(self.fs * self.payload_sec)
+        t = numpy.arange(n) / self.fs
+        # テキストごとに周波数を変えて区別できるようにする
+        freq = 220 + (sum(text.encode("utf-8")) % 440)
+        wav = (numpy.sin(2 * numpy.pi * freq * t) * 8000).astype(numpy.int16)
+        bio = io.BytesIO()
+        with wave.open(bio, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(self.fs)
+            w.writeframes(wav.tobytes())
+        return bio.getvalue()
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                url = urllib.parse.urlparse(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length', 0))
+                if length:
+                    self.rfile.read(length)
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if url.path == '/audio_query':
+                    stub._count('audio_query')
+                    body = json.dumps({"accent_phrases": [], "speedScale": 1.0, "text": query.get('text', '')}).encode("utf-8")
+                    content_type = 'application/json'
+                elif url.path == '/synthesis':
+                    stub._count('synthesis')
+                    body = stub._make_wav(query.get('text', ''))
+                    content_type = 'audio/wav'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=50021)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--payload-sec', type=float, default=1.0)
+    args = parser.parse_args()
+    stub = StubVoiceVox(args.latency, args.payload_sec, port=args.port).start()
+    print('stub voicevox listening on %s:%d' % (stub.host, stub.port))
+    while True:
+        time.sleep(3600)
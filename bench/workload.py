@@ -0,0 +1,34 @@
+import random
+import datetime
+
+# ベンチマーク用のタッチ記録を作ります
+# 返り値は (name, datetime) のリストです
+
+def _at(day, hour, minute):
+    return day.replace(hour=hour, minute=minute, second=0, microsecond=0)
+
+# 各人が1日の中で一様にタッチします
+def uniform_day(names, taps_per_person, day, seed = 0):
+    rnd = random.Random(seed)
+    start = _at(day, 8, 0)
+    ret = []
+    for name in names:
+        for _ in range(taps_per_person):
+            ret.append((name, start + datetime.timedelta(seconds=rnd.randint(0, 12 * 3600))))
+    return ret
+
+# 9:00 前後に全員が集中して入室します
+def morning_burst(names, day, spread_min = 10, seed = 0):
+    rnd = random.Random(seed)
+    center = _at(day, 9, 0)
+    return [(name, center + datetime.timedelta(seconds=rnd.gauss(0, spread_min * 60))) for name in names]
+
+# 17:30 前後に全員が集中して退出します
+def evening_exodus(names, day, spread_min = 10, seed = 0):
+    rnd = random.Random(seed)
+    center = _at(day, 17, 30)
+    return [(name, center + datetime.timedelta(seconds=rnd.gauss(0, spread_min * 60))) for name in names]
+
+# 朝の入室、日中の出入り、夕方の退出を合わせた1日分です
+def lab_day(names, day, seed = 0):
+    return morning_burst(names, day, seed=seed) + uniform_day(names, 2, day, seed=seed + 1) + evening_exodus(names, day, seed=seed + 2)
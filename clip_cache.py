@@ -0,0 +1,308 @@
+import io
+import os
+import json
+import time
+import wave
+import shutil
+import logging
+import hashlib
+import argparse
+import platform
+import threading
+import collections
+import http.server
+import numpy
+
+import metrics
+import http_session
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 合成した音声のキャッシュです
+# キーは音声AIの種類、合成パラメータ、加工の版、テキストから作るので
+# パラメータを変えると別の音声として扱われます
+# 複数のプロセスや端末で共有ディレクトリ (NFS など) か HTTP のブロブサーバを共有できます
+
+BLOB_SERVER_PORT = 9106
+# ブロブサーバに繋がらなかった時にこの秒数は共有キャッシュを使わない
+HTTP_STORE_BACKOFF_SEC = 30
+
+logger = logging.getLogger("klab")
+
+# engine/<sha1> の形のキーを返します
+def make_key(engine, params, text, version):
+    data = json.dumps({"engine": engine, "params": params, "version": version, "text": text}, sort_keys=True, ensure_ascii=False)
+    m = hashlib.sha1()
+    m.update(data.encode("utf-8"))
+    return '%s/%s' % (engine, m.hexdigest())
+
+def encode_wav(wav, fs):
+    bio = io.BytesIO()
+    with wave.open(bio, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(fs)
+        w.writeframes(wav.tobytes())
+    return bio.getvalue()
+
+def decode_wav(data):
+    with wave.open(io.BytesIO(data), "r") as w:
+        fs = w.getframerate()
+        wav = numpy.frombuffer(w.readframes(w.getnframes()), dtype="int16")
+    return (wav, fs)
+
+def _is_valid(data):
+    # 書きかけや壊れたファイルは使わない
+    if data is None or len(data) < 1024:
+        return False
+    try:
+        decode_wav(data)
+    except (wave.Error, EOFError):
+        return False
+    return True
+
+# ディレクトリに保存します
+# 書き込みは一時ファイルからの置き換えで行い、同じディレクトリへの書き込みはファイルロックで排他します
+# ロックファイルはキーごとに作らず、振り分け先のディレクトリに1つだけ置きます
+class DirStore():
+    def __init__(self, root):
+        self._root = root
+
+    def _path(self, key):
+        (engine, digest) = key.split('/', 1)
+        return os.path.join(self._root, engine, digest[:2], digest + '.wav')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if not _is_valid(data):
+            return None
+        return data
+
+    def contains(self, key):
+        return os.path.exists(self._path(key))
+
+    def put(self, key, data):
+        path = self._path(key)
+        dir = os.path.dirname(path)
+        os.makedirs(dir, exist_ok=True)
+        with open(os.path.join(dir, '.lock'), 'a') as lock:
+            if fcntl:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                if _is_valid(self.get(key)):
+                    return
+                tmp = '%s.%s.%d.%d.tmp' % (path, platform.node(), os.getpid(), threading.get_ident())
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, path)
+            finally:
+                if fcntl:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def purge(self, engine):
+        dir = os.path.join(self._root, engine)
+        if os.path.exists(dir):
+            shutil.rmtree(dir)
+
+def _is_engine(engine):
+    return bool(engine) and '/' not in engine and '\\' not in engine and engine not in ('.', '..')
+
+# serve() で公開したブロブサーバに保存します
+# サーバに繋がらない場合はキャッシュ無しとして扱い、backoff_sec 秒は問い合わせずに済ませます
+# (繋がらないサーバを毎回待つとアナウンスが大きく遅れるため)
+# token はサーバを --token 付きで起動した場合に書き込みと削除で送ります
+class HttpStore():
+    def __init__(self, url, timeout = 5.0, token = None, connect_timeout = 0.5, backoff_sec = HTTP_STORE_BACKOFF_SEC):
+        self._url = url.rstrip('/')
+        self._timeout = (connect_timeout, timeout)
+        self._headers = {'X-Cache-Token': token} if token else {}
+        self._backoff_sec = backoff_sec
+        self._down_until = 0.0
+
+    def _http(self):
+        return http_session.get_session()
+
+    # 共有キャッシュを使わない期間中なら None を返します
+    def _request(self, method, key, **kwargs):
+        if time.monotonic() < self._down_until:
+            return None
+        try:
+            return self._http().request(method, '%s/%s.wav' % (self._url, key), timeout=self._timeout, **kwargs)
+        except Exception as e:
+            self._down_until = time.monotonic() + self._backoff_sec
+            metrics.inc("klab_errors_total", stage="cache_shared")
+            logger.warning('event=cache_shared_down url=%s backoff_sec=%d error="%s"', self._url, self._backoff_sec, e)
+            return None
+
+    def get(self, key):
+        res = self._request('GET', key)
+        if res is None or res.status_code != 200 or not _is_valid(res.content):
+            return None
+        return res.content
+
+    def contains(self, key):
+        res = self._request('HEAD', key)
+        return res is not None and res.status_code == 200
+
+    def put(self, key, data):
+        res = self._request('PUT', key, data=data, headers=self._headers)
+        if res is not None and res.status_code not in (200, 201):
+            # トークンの設定違いなどで保存されないと毎回合成し直すことになる
+            metrics.inc("klab_errors_total", stage="cache_put")
+            logger.warning('event=cache_put_failed url=%s key=%s status=%d', self._url, key, res.status_code)
+
+    # 削除できなかった場合は例外にします (消えたつもりで古い音声を使い続けないように)
+    def purge(self, engine):
+        if not _is_engine(engine):
+            raise ValueError('invalid engine name: %s' % engine)
+        res = self._http().delete('%s/%s/' % (self._url, engine), headers=self._headers, timeout=self._timeout)
+        if res.status_code not in (200, 204):
+            raise IOError('purge failed: %s %d' % (engine, res.status_code))
+
+# メモリ → ローカル → 共有 の順に探し、見つかれば上の層にも置きます
+class ClipCache():
+    def __init__(self, shared, local = None, memory_max = 512):
+        self._shared = shared
+        self._local = local
+        self._memory = collections.OrderedDict()
+        self._memory_max = memory_max
+        self._lock = threading.Lock()
+
+    def _remember(self, key, clip):
+        with self._lock:
+            self._memory[key] = clip
+            self._memory.move_to_end(key)
+            while len(self._memory) > self._memory_max:
+                self._memory.popitem(last=False)
+
+    # (wav, fs) と見つかった層 (memory / local / shared / miss) を返します
+    def get(self, key):
+        with self._lock:
+            clip = self._memory.get(key)
+            if clip is not None:
+                self._memory.move_to_end(key)
+                return (clip, 'memory')
+        if self._local:
+            data = self._local.get(key)
+            if data:
+                clip = decode_wav(data)
+                self._remember(key, clip)
+                return (clip, 'local')
+        data = self._shared.get(key)
+        if data:
+            if self._local:
+                self._local.put(key, data)
+            clip = decode_wav(data)
+            self._remember(key, clip)
+            return (clip, 'shared')
+        return (None, 'miss')
+
+    def contains(self, key):
+        with self._lock:
+            if key in self._memory:
+                return True
+        if self._local and self._local.contains(key):
+            return True
+        return self._shared.contains(key)
+
+    def put(self, key, wav, fs):
+        data = encode_wav(wav, fs)
+        self._shared.put(key, data)
+        if self._local:
+            self._local.put(key, data)
+        self._remember(key, (wav, fs))
+
+    def purge(self, engine):
+        with self._lock:
+            for key in [k for k in self._memory if k.startswith(engine + '/')]:
+                del self._memory[key]
+        if self._local:
+            self._local.purge(engine)
+        self._shared.purge(engine)
+
+# 共有ディレクトリの代わりに使う簡単なブロブサーバです
+# GET / HEAD / PUT /<engine>/<hash>.wav
+# DELETE /<engine>/ でその名前空間を消します
+# 既定ではこの端末からしか繋がりません。他の端末と共有する時は host を指定し、token で書き込みを制限してください
+def serve(root, port = BLOB_SERVER_PORT, host = '127.0.0.1', token = None):
+    store = DirStore(root)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def _key(self):
+            path = self.path.split('?')[0].strip('/')
+            if not path.endswith('.wav') or path.count('/') != 1 or '..' in path:
+                return None
+            return path[:-len('.wav')]
+
+        def _send(self, code, body = b''):
+            self.send_response(code)
+            self.send_header('Content-Type', 'audio/wav')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if body and self.command != 'HEAD':
+                self.wfile.write(body)
+
+        def do_GET(self):
+            key = self._key()
+            data = store.get(key) if key else None
+            if data is None:
+                self._send(404)
+                return
+            self._send(200, data)
+
+        def do_HEAD(self):
+            key = self._key()
+            self._send(200 if key and store.contains(key) else 404)
+
+        def _authorized(self):
+            if token and self.headers.get('X-Cache-Token') != token:
+                self._send(403)
+                return False
+            return True
+
+        def do_PUT(self):
+            if not self._authorized():
+                return
+            key = self._key()
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if key is None or not _is_valid(data):
+                self._send(400)
+                return
+            store.put(key, data)
+            self._send(201)
+
+        def do_DELETE(self):
+            if not self._authorized():
+                return
+            path = self.path.split('?')[0]
+            engine = path.strip('/')
+            if not path.endswith('/') or not _is_engine(engine):
+                self._send(400)
+                return
+            store.purge(engine)
+            self._send(204)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default='clip_cache')
+    parser.add_argument('--port', type=int, default=BLOB_SERVER_PORT)
+    parser.add_argument('--host', default='127.0.0.1', help='use 0.0.0.0 to share with other machines')
+    parser.add_argument('--token', help='require this X-Cache-Token header for PUT and DELETE')
+    args = parser.parse_args()
+    serve(args.dir, args.port, args.host, args.token)
@@ -0,0 +1,93 @@
+import numpy
+
+import clip_cache
+import metrics
+
+# 「名前 + 挨拶」を1つの音声にまとめて事前に作っておきます
+# 音量をそろえ、つなぎ目を短くクロスフェードします
+
+# 音量の目標値 (無音部分を除いた RMS)
+COMPOSITE_TARGET_DBFS = -20.0
+# ピークがこの値を超えないようにゲインを抑える
+COMPOSITE_PEAK_DBFS = -1.0
+COMPOSITE_CROSSFADE_SEC = 0.02
+# 前後の端のノイズを消すフェード
+COMPOSITE_EDGE_FADE_SEC = 0.005
+# 処理内容を変えたら上げると全て作り直されます
+RENDER_VERSION = 1
+
+def _db_to_amp(db):
+    return 10.0 ** (db / 20.0)
+
+# 無音部分を除いた RMS が target_dbfs になるようにゲインをかけます
+def normalize_loudness(x, target_dbfs = COMPOSITE_TARGET_DBFS, peak_dbfs = COMPOSITE_PEAK_DBFS):
+    active = numpy.abs(x) > 1e-3
+    if not numpy.any(active):
+        return x
+    rms = numpy.sqrt(numpy.mean(numpy.square(x[active])))
+    gain = _db_to_amp(target_dbfs) / rms
+    peak = numpy.max(numpy.abs(x))
+    gain = min(gain, _db_to_amp(peak_dbfs) / peak)
+    return x * gain
+
+def fade_edges(x, n):
+    n = min(n, len(x) // 2)
+    if n < 1:
+        return x
+    x = x.copy()
+    ramp = numpy.linspace(0.0, 1.0, n, endpoint=False)
+    x[:n] *= ramp
+    x[-n:] *= ramp[::-1]
+    return x
+
+# a の終わりと b の始まりを n サンプル重ねます (等パワー)
+def crossfade(a, b, n):
+    n = min(n, len(a), len(b))
+    if n < 1:
+        return numpy.concatenate([a, b])
+    t = numpy.linspace(0.0, numpy.pi / 2, n)
+    mixed = a[-n:] * numpy.cos(t) + b[:n] * numpy.sin(t)
+    return numpy.concatenate([a[:-n], mixed, b[n:]])
+
+def render(wav_list, fs):
+    out = None
+    edge = int(fs * COMPOSITE_EDGE_FADE_SEC)
+    for wav in wav_list:
+        x = normalize_loudness(wav.astype(numpy.float32) / 32768.0)
+        x = fade_edges(x, edge)
+        out = x if out is None else crossfade(out, x, int(fs * COMPOSITE_CROSSFADE_SEC))
+    return (numpy.clip(out, -1.0, 32767.0 / 32768.0) * 32768.0).astype(numpy.int16)
+
+# 音声AIごとの合成済みアナウンスです
+# 部品のキャッシュキーから作ったキーでクリップキャッシュに保存するので、部品が変わると別のキーになります
+# 他のプロセスや端末で作ったものもそのまま使えます
+class CompositeCache():
+    def __init__(self, ai, cache):
+        self._ai = ai
+        self._cache = cache
+
+    def _key(self, texts):
+        parts = [self._ai.cache_key(text) for text in texts]
+        return clip_cache.make_key(self._ai._engine_name(), {"composite": parts}, '', RENDER_VERSION)
+
+    # 必要なら部品を合成してアナウンスを作ります
+    # 作り直した場合は True を返します
+    def build(self, texts):
+        key = self._key(texts)
+        if self._cache.contains(key):
+            return False
+        parts = [self._ai.generate_wav(text) for text in texts]
+        if not all(parts):
+            return False
+        fs = parts[-1][1]
+        self._cache.put(key, render([w for (w, _) in parts], fs), fs)
+        return True
+
+    # 作成済みのアナウンスを返します (無ければ None)
+    def get(self, texts):
+        (clip, _) = self._cache.get(self._key(texts))
+        if clip is None:
+            metrics.inc("klab_composite_misses_total", engine=self._ai._ai_name())
+        else:
+            metrics.inc("klab_composite_hits_total", engine=self._ai._ai_name())
+        return clip
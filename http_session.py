@@ -0,0 +1,15 @@
+import threading
+
+# 音声エンジンやブロブサーバとの通信に使う HTTP セッションです
+# requests.Session はスレッドセーフではないのでスレッドごとに作り、そのスレッドの中で接続を使い回します
+
+_sessions = threading.local()
+
+def get_session():
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        # requests を使わない環境でも import できるように遅延 import
+        import requests
+        session = requests.Session()
+        _sessions.session = session
+    return session
@@ -1,28 +1,171 @@
+import time
+# 起動から最初のポーリングまでの時間を計るための基準
+_t_start = time.perf_counter()
 import os
 import io
 import json
-import time
 import wave
 import numpy
-import shutil
-import hashlib
+import queue
+import logging
+import argparse
 import datetime
-import requests
-import sounddevice
-import mysql.connector
-import mysql.connector.pooling
-from dateutil.relativedelta import relativedelta
+import threading
+import concurrent.futures
+import metrics
+import composite
+import resample
+import clip_cache
+import audio_sink
+import http_session
+
+logger = logging.getLogger("klab")
 
 DB_HOST = "kuwanolabserver.iis.u-tokyo.ac.jp"
 DB_NAME = "felica_db"
 DB_USER = "bw304"
 DB_PASS = "UpomPmBu"
 DB_PORT = 3306
-pool = mysql.connector.pooling.MySQLConnectionPool(user=DB_USER, password=DB_PASS, database=DB_NAME, host=DB_HOST, port=DB_PORT, pool_size=16)
+# 接続は必要になった分だけ作り、この数まで増やす
+DB_POOL_MAX = 16
+# 再起動時に読み込むアナウンス状態の保存先
+STATE_PATH = "klab_state.json"
+# 停止中に発生したタッチをこの分数だけ遡ってアナウンスする
+STATE_GRACE_MIN = 10
+# 音声の出力先 (sounddevice / null / wav / ring)
+AUDIO_SINK = "sounddevice"
+# 音声キャッシュの保存先 (複数の端末で共有するなら NFS などのディレクトリ)
+CACHE_DIR = "clip_cache"
+# 共有ディレクトリの代わりに使うブロブサーバ (例: "http://kuwanolabserver.iis.u-tokyo.ac.jp:9106")
+CACHE_URL = None
+# 共有キャッシュの手前に置くローカルのキャッシュ (使わないなら None)
+LOCAL_CACHE_DIR = None
+# ブロブサーバを --token 付きで起動した場合の書き込み用トークン
+CACHE_TOKEN = None
+# 再生時のサンプリング周波数
+# 音声はキャッシュする時にこの周波数に変換しておく (キャッシュを共有する端末ではそろえる)
+# 再生するデバイスの周波数に合わせること (44.1kHz のデバイスなら 44100)
+# 違う場合は再生のたびに変換が入り、警告と klab_resample_seconds{stage="play"} に記録される
+OUTPUT_FS = 48000
+# 長い文はこの文字数以下に区切って合成する
+SENTENCE_CHUNK_MAX = 30
+# 事前に音声を用意しておくメンバー
+NAME_LIST = ['Reiko Kuwano', 'Masahide Otsubo', 'Makoto Kuno', 'Satoko Kichibayashi', 'Eiko Yoshimoto', 'Itsuki Sato', 'Chitravel Sanjei', 'Li Yang', 'Liu Junming', 'Naqi Ali', 'Daichi Yokoyama', 'Yohei Karasaki', 'Chhoeur Pryalen', 'Yutaro Hara', 'Koki Horinouchi', 'Horoyuki Hashimoto', 'Reiji Hirano', 'Natsuho Futakuchi', 'Akira Sato']
+VOICEVOX_HOST = "kuwanolabserver.iis.u-tokyo.ac.jp"
+VOICEVOX_PORT = 50021 ##CPU
+#VOICEVOX_PORT = 50022 ## GPU
+pool = None
+_lazy_lock = threading.Lock()
+
+# 貸し出し中の接続です
+# close() で切断せずにプールへ返却します
+class _PooledConnection():
+    def __init__(self, pool, con):
+        self._pool = pool
+        self._con = con
+
+    def cursor(self, *args, **kwargs):
+        return self._con.cursor(*args, **kwargs)
+
+    def commit(self):
+        return self._con.commit()
+
+    def close(self):
+        if self._con is not None:
+            self._pool._release(self._con)
+            self._con = None
+
+# 最初は接続を持たず、同時に使われる数に合わせて max_size まで増える接続プールです
+class ConnectionPool():
+    def __init__(self, max_size = DB_POOL_MAX, **config):
+        self._config = config
+        self._max_size = max_size
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+
+    # autocommit にしないと REPEATABLE READ で最初の SELECT のスナップショットを読み続け、
+    # 使い回した接続から新しいタッチが見えなくなる
+    def _connect(self):
+        import mysql.connector
+        return mysql.connector.connect(autocommit=True, **self._config)
+
+    # 貸し出す前に毎回生存確認し、切れていれば作り直します
+    def _is_healthy(self, con):
+        try:
+            return con.is_connected()
+        except Exception:
+            return False
+
+    def _discard(self, con):
+        try:
+            con.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            metrics.set_gauge("klab_pool_size", self._size)
+            self._cond.notify()
+
+    def get_connection(self):
+        while True:
+            con = None
+            with self._cond:
+                while not self._idle and self._size >= self._max_size:
+                    self._cond.wait()
+                if self._idle:
+                    con = self._idle.pop()
+                else:
+                    self._size += 1
+                    metrics.set_gauge("klab_pool_size", self._size)
+            if con is None:
+                try:
+                    con = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        metrics.set_gauge("klab_pool_size", self._size)
+                        self._cond.notify()
+                    raise
+                return _PooledConnection(self, con)
+            if self._is_healthy(con):
+                return _PooledConnection(self, con)
+            logger.info('event=pool_reconnect')
+            self._discard(con)
+
+    # 返却時に残ったトランザクションを終わらせます
+    def _release(self, con):
+        try:
+            if getattr(con, 'in_transaction', False):
+                con.rollback()
+        except Exception:
+            self._discard(con)
+            return
+        with self._cond:
+            self._idle.append(con)
+            self._cond.notify()
+
+    def size(self):
+        with self._cond:
+            return self._size
+
+# 最初に使われた時に接続プールを作成します
+def _get_pool():
+    global pool
+    if pool is None:
+        with _lazy_lock:
+            if pool is None:
+                pool = ConnectionPool(user=DB_USER, password=DB_PASS, database=DB_NAME, host=DB_HOST, port=DB_PORT)
+    return pool
+
+# 音声エンジンとの通信に使う HTTP セッションです
+def _http():
+    return http_session.get_session()
 
 class Database():
     def _get_mariadb_con(self):
-        return pool.get_connection()
+        with metrics.timed("klab_pool_checkout_seconds"):
+            return _get_pool().get_connection()
 
     def get_datetime_list(self, name, ymd_from, ymd_to):
         ret = {}
@@ -110,7 +253,7 @@ class Database():
         ret = {}
 
         today = datetime.datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
-        tomorrow = today + relativedelta(days=1)
+        tomorrow = today + datetime.timedelta(days=1)
 
         for name in self.get_name_list():
             dict = self.get_datetime_list(name, today.strftime("%Y%m%d"), tomorrow.strftime("%Y%m%d"))
@@ -146,59 +289,82 @@ class Database():
             ret = True
         return ret
 
+_clip_cache = None
+
+# 設定に従って共有キャッシュの保存先を作ります
+def make_shared_store():
+    if CACHE_URL:
+        return clip_cache.HttpStore(CACHE_URL, token=CACHE_TOKEN)
+    return clip_cache.DirStore(CACHE_DIR)
+
+# 音声キャッシュです
+def get_clip_cache():
+    global _clip_cache
+    if _clip_cache is None:
+        with _lazy_lock:
+            if _clip_cache is None:
+                shared = make_shared_store()
+                local = clip_cache.DirStore(LOCAL_CACHE_DIR) if LOCAL_CACHE_DIR else None
+                _clip_cache = clip_cache.ClipCache(shared, local)
+    return _clip_cache
+
 class VoiceAi():
-    def _get_hash(self, text):
-        m=hashlib.sha1()
-        m.update(text.encode("utf-8"))
-        return m.hexdigest()
-
-    def _make_path(self, text):
-        dir = self._ai_name()
-        if not os.path.exists(dir):
-            os.mkdir(dir)
-        hash = self._get_hash(text) + '.wav'
-        path = os.path.join(dir,hash)
-        return path
-
-    def _get_cached_wav(self, text):
-        path = self._make_path(text)
-
-        if not os.path.exists(path):
-            return None
-        if os.path.getsize(path) < 1024:
-            os.remove(path)
-            return None
-        with wave.open(path, "r") as wav:
-            fs = wav.getframerate()
-            wav = numpy.frombuffer(wav.readframes(wav.getnframes()) , dtype= "int16")
-            return (wav, fs)
-
-    def _cache_wav(self, text, wav, fs):
-        path = self._make_path(text)
-        if os.path.exists(path):
-            return
-        with wave.open(path, "wb") as w:
-            w.setnchannels(1)
-            w.setsampwidth(2)
-            w.setframerate(fs)
-            w.writeframes(wav.tobytes())
+    # 音声の加工方法を変えたら上げるとキャッシュが作り直されます
+    _cache_version = 1
+
+    # キャッシュの名前空間に使う音声AIの種類と話者です
+    # cache_purge() で話者ごとに消せるように話者ごとに分けます
+    def _engine_name(self) -> str:
+        raise NotImplementedError()
+
+    # 合成結果に影響するパラメータです
+    def _cache_params(self) -> dict:
+        raise NotImplementedError()
+
+    def cache_key(self, text):
+        params = dict(self._cache_params())
+        params["output_fs"] = get_output_rate()
+        return clip_cache.make_key(self._engine_name(), params, text, self._cache_version)
+
+    def _get_cached_wav(self, key):
+        return get_clip_cache().get(key)
+
+    def is_cached(self, text):
+        return get_clip_cache().contains(self.cache_key(text))
+
+    def _cache_wav(self, key, wav, fs):
+        get_clip_cache().put(key, wav, fs)
 
     def cache_purge(self):
-        dir = self._ai_name()
-        if os.path.exists(dir):
-            shutil.rmtree(dir)
+        get_clip_cache().purge(self._engine_name())
 
     def generate_wav(self, text):
-        ret = self._get_cached_wav(text)
+        key = self.cache_key(text)
+        with metrics.timed("klab_cache_lookup_seconds", engine=self._ai_name()) as labels:
+            (ret, layer) = self._get_cached_wav(key)
+            labels["result"] = layer
         if ret:
-            print('DEBUG: %s is Found. Use cached wav file. path:%s' % (text, self._make_path(text)))
+            metrics.inc("klab_cache_hits_total", engine=self._ai_name())
+            logger.debug('event=cache_hit engine=%s layer=%s text=%s key=%s', self._ai_name(), layer, text, key)
             return ret
-        print('DEBUG: %s is Not Found. File will be generated. path:%s' % (text, self._make_path(text)))
-        ret = self._generate_wav(text)
+        metrics.inc("klab_cache_misses_total", engine=self._ai_name())
+        logger.debug('event=cache_miss engine=%s text=%s key=%s', self._ai_name(), text, key)
+        try:
+            ret = self._generate_wav(text)
+        except Exception:
+            metrics.inc("klab_errors_total", stage="synthesis")
+            raise
         if not ret:
+            metrics.inc("klab_errors_total", stage="synthesis")
             return None
         (wav, fs) = ret
-        self._cache_wav(text, wav, fs)
+        # 再生時に変換しなくて済むように出力先の周波数にしてから保存する
+        out_fs = get_output_rate()
+        if fs != out_fs:
+            with metrics.timed("klab_resample_seconds", engine=self._ai_name()):
+                wav = resample.resample(wav, fs, out_fs)
+            fs = out_fs
+        self._cache_wav(key, wav, fs)
         return (wav, fs)
 
     def _ai_name(self) -> str:
@@ -214,63 +380,96 @@ class VoiceVox(VoiceAi):
     def set_speaker(self, id):
         self._speaker_id = id
 
+    # 先頭と末尾を削っている
+    _cache_version = 'trim32-1'
+
     def _ai_name(self):
         return 'VoiceVox_Speaker_%03d' % self._speaker_id
 
+    def _engine_name(self):
+        return 'voicevox_%03d' % self._speaker_id
+
+    def _cache_params(self):
+        return {"speaker": self._speaker_id}
+
     def _generate_wav(self, text):
-        host = 'kuwanolabserver.iis.u-tokyo.ac.jp'
-        port = 50021 ##CPU
-        #port = 50022 ## GPU
+        host = VOICEVOX_HOST
+        port = VOICEVOX_PORT
         params = (('text', text),('speaker', self._speaker_id),)
-        response1 = requests.post(f'http://{host}:{port}/audio_query', params=params )
+        with metrics.timed("klab_engine_request_seconds", engine="voicevox", endpoint="audio_query"):
+            response1 = _http().post(f'http://{host}:{port}/audio_query', params=params )
         headers = {'Content-Type': 'application/json',}
-        response2 = requests.post(
-            f'http://{host}:{port}/synthesis',
-            headers=headers,
-            params=params,
-            data=json.dumps(response1.json())
-        )
+        with metrics.timed("klab_engine_request_seconds", engine="voicevox", endpoint="synthesis"):
+            response2 = _http().post(
+                f'http://{host}:{port}/synthesis',
+                headers=headers,
+                params=params,
+                data=json.dumps(response1.json())
+            )
 
         fs = 24000
-        # 先頭がおかしい時がある事への対策
-        wav = numpy.frombuffer(response2.content, numpy.int16)[32:-1]
+        with metrics.timed("klab_decode_seconds", engine="voicevox"):
+            # 先頭がおかしい時がある事への対策
+            wav = numpy.frombuffer(response2.content, numpy.int16)[32:-1]
         return (wav, fs)
 
 class AkaneChan(VoiceAi):
     _speaker_id = 522
+    # 先頭の0.5秒の無音までを削っている
+    _cache_version = 'silence0.5-1'
+
+    def __init__(self):
+        self._params = {}
+        self._params["volume"] = "1.0"
+        self._params["speed"] = "1.3"
+        self._params["pitch"] = "1.0"
+        self._params["range"] = "1.0"
+        self._params["anger"] = "0.0"
+        self._params["sadness"] = "0.0"
+        self._params["joy"] = "0.0"
 
     def set_speaker(self, id):
         self._speaker_id = id
 
+    # volume / speed / pitch / range / anger / sadness / joy を変更します
+    def set_param(self, name, value):
+        if name not in self._params:
+            raise KeyError(name)
+        self._params[name] = str(value)
+
     def _ai_name(self):
         return 'AkaneChan_%03d' % self._speaker_id
 
+    def _engine_name(self):
+        return 'aitalk_%03d' % self._speaker_id
+
+    def _cache_params(self):
+        params = dict(self._params)
+        params["speaker_id"] = self._speaker_id
+        return params
+
     def _get_data_url(self, text) -> str:
         data = {}
         data["api-version"] = "v5"
         data["speaker_id"] = str(self._speaker_id)
         data["text"] = text
         data["ext"] = "wav"
-        data["volume"] = "1.0"
-        data["speed"] = "1.3"
-        data["pitch"] = "1.0"
-        data["range"] = "1.0"
-        data["anger"] = "0.0"
-        data["sadness"] = "0.0"
-        data["joy"] = "0.0"
+        data.update(self._params)
         data["callback"] = "callback"
         headers = {}
         headers["content-type"] = "application/x-www-form-urlencoded"
         url = "https://cloud.ai-j.jp/demo/aitalk2webapi_nop.php"
-        res = requests.post(url, data=data, headers = headers)
+        with metrics.timed("klab_engine_request_seconds", engine="aitalk", endpoint="aitalk2webapi"):
+            res = _http().post(url, data=data, headers = headers)
         res = res.text.split('(')[1].split(")")[0]
         return "https:" + json.loads(res)["url"]
 
     def _download(self, url) -> io.BytesIO:
         bio = io.BytesIO()
-        res = requests.get(url, stream=True)
-        if res.status_code == 200:
-            bio.write(res.content)
+        with metrics.timed("klab_engine_request_seconds", engine="aitalk", endpoint="download"):
+            res = _http().get(url, stream=True)
+            if res.status_code == 200:
+                bio.write(res.content)
         bio.seek(0)
         return bio
 
@@ -291,7 +490,26 @@ class AkaneChan(VoiceAi):
     def _generate_wav(self, text):
         url = self._get_data_url(text)
         bio = self._download(url)
-        return self._trimmed_wav(bio)
+        with metrics.timed("klab_decode_seconds", engine="aitalk"):
+            return self._trimmed_wav(bio)
+
+_sink = None
+
+# 音声の出力先を切り替えます
+def set_sink(sink):
+    global _sink
+    if isinstance(sink, str):
+        sink = audio_sink.make_sink(sink)
+    _sink = sink
+
+def get_sink():
+    if _sink is None:
+        set_sink(AUDIO_SINK)
+    return _sink
+
+# キャッシュのキーに入るので出力先のデバイスには問い合わせません
+def get_output_rate():
+    return OUTPUT_FS
 
 def Prepare(text, mode = None):
     ai = VoiceVox()
@@ -303,31 +521,196 @@ def Talk(text, mode = None):
         ai = AkaneChan()
     (wav, fs) = ai.generate_wav(text)
 
-    sounddevice.play(wav, fs)
-    time.sleep(len(wav)/fs + 1.0)
-
-def Talk_Sentence(sentense, mode = None):
+    sink = get_sink()
+    sink.play(wav, fs)
+    sink.wait(1.0)
+
+# 文の区切りとして扱う句読点
+_CHUNK_PUNCT = '。、！？!?．，'
+# この文字の直前では区切らない
+_NO_BREAK_BEFORE = 'ぁぃぅぇぉっゃゅょゎァィゥェォッャュョヮー' + _CHUNK_PUNCT
+# 文字数で切る時はこの助詞の後ろを優先する
+_CHUNK_PARTICLE = 'はがをにでともへのや'
+# 文字数で切った結果これより短い末尾は前の塊に戻す
+_CHUNK_MIN = 5
+
+def _script(c):
+    if '\u3040' <= c <= '\u309f':
+        return 'hiragana'
+    if '\u30a0' <= c <= '\u30ff':
+        return 'katakana'
+    if '\u4e00' <= c <= '\u9fff' or c in '々〆ヶ':
+        return 'kanji'
+    if c.isascii() and c.isalnum():
+        return 'ascii'
+    return 'other'
+
+# text[:max_len] の中で区切ってよい最後の位置を返します
+# 助詞の後ろ → 文字の種類が変わる所 → 小さい仮名や長音の前以外 の順に探します
+# 塊が短くなりすぎないよう _CHUNK_MIN 文字目より前では切りません
+def _find_cut(text, max_len):
+    # text[j-2] を見るので j は 2 以上
+    candidates = range(max_len, max(2, min(_CHUNK_MIN, max_len - 1)) - 1, -1)
+    for j in candidates:
+        c = text[j-1]
+        if text[j] in _NO_BREAK_BEFORE or c not in _CHUNK_PARTICLE:
+            continue
+        # 「この」「できる」のような語の途中の仮名は助詞として扱わない
+        if _script(text[j-2]) != 'hiragana' or _script(text[j]) != 'hiragana':
+            return j
+    # 漢字 → 送り仮名 は語の途中なので、仮名以外が始まる所だけを見る
+    for j in candidates:
+        if text[j] in _NO_BREAK_BEFORE or _script(text[j]) == 'hiragana':
+            continue
+        if _script(text[j-1]) != _script(text[j]):
+            return j
+    for j in candidates:
+        if text[j] not in _NO_BREAK_BEFORE:
+            return j
+    # 長音が続くなどで区切れる所が無い場合はそのまま切る
+    return max_len
+
+# 句読点と文字数で文を区切ります
+# 句読点は直前の塊に含めるので抑揚が崩れにくくなります
+# 文字数で切る時は語の途中を避け、短すぎる末尾は前の塊に含めます (max_len を少し超えることがあります)
+def split_sentence(text, max_len = SENTENCE_CHUNK_MAX):
+    # まず句読点で区切る (「！？」のように続く句読点は前の塊にまとめる)
+    segments = []
+    buf = ''
+    for (i, c) in enumerate(text):
+        buf += c
+        if c in _CHUNK_PUNCT and text[i+1:i+2] not in _CHUNK_PUNCT:
+            segments.append(buf.strip())
+            buf = ''
+    segments.append(buf.strip())
+
+    ret = []
+    for seg in segments:
+        # 句読点だけの塊は読み上げるものが無いので捨てる
+        if not seg.strip(_CHUNK_PUNCT).strip():
+            continue
+        pieces = []
+        # 空白で切った所に戻す時は空白も戻す
+        sep = ''
+        while len(seg) > max_len:
+            j = _find_cut(seg, max_len)
+            sep = ' ' if seg[j-1].isspace() or seg[j].isspace() else ''
+            pieces.append(seg[:j].strip())
+            seg = seg[j:].strip()
+        if pieces and len(seg.strip(_CHUNK_PUNCT)) < _CHUNK_MIN:
+            pieces[-1] += sep + seg
+        elif seg:
+            pieces.append(seg)
+        ret += pieces
+    return ret
+
+_synth_executor = None
+
+# 先行合成に使うスレッドです
+# 毎回スレッドを作るとスレッドごとの HTTP セッションが使い回されないので1本を使い続けます
+def _get_synth_executor():
+    global _synth_executor
+    if _synth_executor is None:
+        with _lazy_lock:
+            if _synth_executor is None:
+                _synth_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='synth')
+    return _synth_executor
+
+# 文を区切って順に合成し、できた所から再生します
+# 区切りごとにキャッシュされるので同じ言い回しは再利用されます
+# t_event を渡すとイベント検出から再生開始までの時間を記録します
+# on_audio は最初の音声を再生する直前に1回だけ呼ばれます
+def Talk_Sentence(sentense, mode = None, t_event = None, on_audio = None):
     ai = VoiceVox()
     if mode and mode == 'kansai':
         ai = AkaneChan()
-    wav = None
-    fs = 0
     if type(sentense) is not list:
         sentense = sentense.split(' ')
+    chunks = []
     for text in sentense:
-        (w, fs) = ai.generate_wav(text)
-        if wav is None:
-            wav = w
-        else:
-            wav = numpy.concatenate([wav, w], 0)
+        chunks += split_sentence(text)
+    if not chunks:
+        return
 
-    sounddevice.play(wav, fs)
-    time.sleep(len(wav)/fs + 1)
+    # 合成は別スレッドで先行させる
+    q = queue.Queue()
+    def produce():
+        try:
+            for text in chunks:
+                q.put(ai.generate_wav(text))
+        except Exception as e:
+            q.put(e)
+
+    _get_synth_executor().submit(produce)
+    sink = get_sink()
+    index = 0
+    while index < len(chunks):
+        # 次の塊がキャッシュ済みなら待って連結し、未合成なら手元の分を先に再生する
+        wav_list = []
+        fs = get_output_rate()
+        while index < len(chunks):
+            if wav_list and q.empty() and not ai.is_cached(chunks[index]):
+                break
+            item = q.get()
+            index += 1
+            if isinstance(item, Exception):
+                raise item
+            if item:
+                (w, f) = item
+                # キャッシュ済みの音声は出力先の周波数なので通常は変換しない
+                if f != fs:
+                    w = resample.resample(w, f, fs)
+                wav_list.append(w)
+        if not wav_list:
+            continue
+        if t_event is not None:
+            metrics.observe("klab_first_audio_seconds", time.perf_counter() - t_event)
+            t_event = None
+        if on_audio is not None:
+            on_audio()
+            on_audio = None
+        sink.play(numpy.concatenate(wav_list, 0), fs)
+    sink.wait(1.0)
+
+_composites = {}
+
+# 音声AIごとの合成済みアナウンスです
+def get_composite_cache(mode = None):
+    ai = VoiceVox()
+    if mode and mode == 'kansai':
+        ai = AkaneChan()
+    name = ai._ai_name()
+    if name not in _composites:
+        _composites[name] = composite.CompositeCache(ai, get_clip_cache())
+    return _composites[name]
+
+# 名前と挨拶をつなげたアナウンスを再生します
+# 事前に作成済みならそのまま1回で再生し、無ければ部品から組み立てます
+# 組み立てた場合は部品がキャッシュされているので、次回のために合成済みのものも作っておきます
+def Talk_Announcement(jpn_name, message, mode = None, t_event = None, on_audio = None):
+    cache = get_composite_cache(mode)
+    ret = cache.get([jpn_name, message])
+    if ret is None:
+        Talk_Sentence([jpn_name, message], mode, t_event, on_audio)
+        try:
+            cache.build([jpn_name, message])
+        except Exception as e:
+            metrics.inc("klab_errors_total", stage="render")
+            logger.warning('event=render_failed name="%s" error="%s"', jpn_name, e)
+        return
+    (wav, fs) = ret
+    if t_event is not None:
+        metrics.observe("klab_first_audio_seconds", time.perf_counter() - t_event)
+    if on_audio is not None:
+        on_audio()
+    sink = get_sink()
+    sink.play(wav, fs)
+    sink.wait(1.0)
 
 class klab:
     # 今日のログイン者の情報を取得します
     def _get_json(self):
-        return Database().get_today_list()
+        return self._db.get_today_list()
 
     # ログインの最初と最後を判別します
     def _find_enter_exit_time(self, list):
@@ -349,14 +732,79 @@ class klab:
                 exit = None
         return (enter, exit)
 
+    # 現在時刻です (リプレイでは仮想時刻に置き換えます)
+    def _now(self):
+        return datetime.datetime.now()
+
     # 初期化処理
-    def __init__(self, debug = False):
+    # state_path を省略すると通常は STATE_PATH に状態を保存し、debug の時は保存しません
+    def __init__(self, debug = False, database = None, state_path = None):
+        self._db = database if database is not None else Database()
+        if state_path is None and debug is False:
+            state_path = STATE_PATH
+        self._state_path = state_path
         self._check_dict = {}
-        self._prev_datetime = datetime.datetime.now()
-        # 起動時にチェックをして読み捨てることで
-        # しゃべり続けるのを防止
-        if debug is False:
-            self.check()
+        # 検出したがまだアナウンスしていないイベント {(name, kind): タッチ時刻}
+        # 状態ファイルにはアナウンス済みとして保存しない
+        self._pending = {}
+        self._prev_datetime = self._now()
+        # この時刻より前のタッチは記録のみでアナウンスしない
+        # 状態ファイルが無い場合は起動時刻以降のみ
+        # (起動時のチェックを読み捨てていたのと同じ効果で、余分な問い合わせは不要)
+        self._replay_since = self._prev_datetime.replace(microsecond=0)
+        if self._state_path:
+            self._load_state()
+
+    # 保存した状態を読み込みます
+    # 同じ日の状態であれば猶予時間内の取りこぼしを再アナウンスします
+    def _load_state(self):
+        try:
+            with open(self._state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            watermark = datetime.datetime.strptime(state["watermark"], '%Y-%m-%d %H:%M:%S')
+            check_dict = state["check_dict"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        # 壊れた状態ファイルで check() が毎回失敗しないように形を確かめる
+        if not isinstance(check_dict, dict) or not all(isinstance(v, dict) for v in check_dict.values()):
+            logger.warning('event=state_ignored path=%s reason=malformed', self._state_path)
+            return False
+        now = self._now()
+        if not self._is_same_day(watermark, now):
+            return False
+        self._check_dict = check_dict
+        self._prev_datetime = watermark
+        self._replay_since = max(watermark, now - datetime.timedelta(minutes=STATE_GRACE_MIN))
+        return True
+
+    # 状態をアトミックに保存します
+    # アナウンス待ちのイベントは未チェックとして保存し、水位もそのタッチ時刻まで戻すので
+    # 途中で停止しても再起動後にアナウンスされます
+    def _save_state(self):
+        check_dict = {}
+        for (name, item) in self._check_dict.items():
+            check_dict[name] = {kind: value for (kind, value) in item.items() if (name, kind) not in self._pending}
+        watermark = min([self._prev_datetime] + list(self._pending.values()))
+        state = {}
+        state["watermark"] = watermark.strftime('%Y-%m-%d %H:%M:%S')
+        state["check_dict"] = check_dict
+        tmp = self._state_path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(state, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._state_path)
+        except OSError as e:
+            metrics.inc("klab_errors_total", stage="state")
+            logger.warning('event=state_save_failed path=%s error="%s"', self._state_path, e)
+
+    def _is_same_day(self, day_a, day_b):
+        return day_a.year == day_b.year and day_a.month == day_b.month and day_a.day == day_b.day
+
+    # 猶予時間より前のタッチはアナウンスしません
+    def _is_replayable(self, dt):
+        return self._replay_since is None or dt >= self._replay_since
 
     # 入退出者を確認します
     # 返り値はそれぞれlist型です
@@ -364,16 +812,20 @@ class klab:
     def check(self):
         enter_name_list = []
         exit_name_list = []
-        now = datetime.datetime.now()
+        now = self._now()
+        changed = False
 
         # 日付が越えてないかチェック
         if now.day != self._prev_datetime.day:
             # 越えていれば初期化
-            self._prev_datetime = now
             self._check_dict = {}
+            self._pending = {}
+            self._replay_since = None
+            changed = True
 
         # 差分をチェック
-        json = self._get_json()
+        with metrics.timed("klab_db_poll_seconds"):
+            json = self._get_json()
         name_list = list(json.keys())
         for name in name_list:
             dt_list = json[name]
@@ -382,23 +834,37 @@ class klab:
             # もし一度もチェックされていない場合
             if name not in self._check_dict:
                 self._check_dict[name] = {}
-                if enter is not None:
-                    enter_name_list.append(name)
-                    self._check_dict[name]["enter"] = True
-                if exit is not None:
-                    exit_name_list.append(name)
-                    self._check_dict[name]["exit"] = True
-            # 2回目以降のチェックの場合
-            else:
-                if enter is not None and self._check_dict[name].get("enter") is None:
+                changed = True
+            if enter is not None and self._check_dict[name].get("enter") is None:
+                if self._is_replayable(enter):
                     enter_name_list.append(name)
-                    self._check_dict[name]["enter"] = True
-                if exit is not None and  self._check_dict[name].get("exit") is None:
+                    self._pending[(name, "enter")] = enter
+                self._check_dict[name]["enter"] = True
+                changed = True
+            if exit is not None and self._check_dict[name].get("exit") is None:
+                if self._is_replayable(exit):
                     exit_name_list.append(name)
-                    self._check_dict[name]["exit"] = True
+                    self._pending[(name, "exit")] = exit
+                self._check_dict[name]["exit"] = True
+                changed = True
+
+        # 取りこぼしの再生は起動後最初のチェックのみ
+        self._replay_since = None
+        # 問い合わせ時刻を水位として記録
+        self._prev_datetime = now
+        if changed and self._state_path:
+            self._save_state()
 
         return (enter_name_list, exit_name_list)
 
+    # check() で返したイベントのアナウンスが終わったら呼んでください
+    # ここで初めてアナウンス済みとして保存します
+    def mark_announced(self, name, kind):
+        if self._pending.pop((name, kind), None) is None:
+            return
+        if self._state_path:
+            self._save_state()
+
     # デバッグ用関数です
     # 適当な名前を適当に返します
     def debug_check(self):
@@ -406,7 +872,7 @@ class klab:
         prob = 0.97
         enter_name_list = []
         exit_name_list = []
-        name_list = ['Reiko Kuwano', 'Masahide Otsubo', 'Makoto Kuno', 'Satoko Kichibayashi', 'Eiko Yoshimoto', 'Itsuki Sato', 'Chitravel Sanjei', 'Li Yang', 'Liu Junming', 'Naqi Ali', 'Daichi Yokoyama', 'Yohei Karasaki', 'Chhoeur Pryalen', 'Yutaro Hara', 'Koki Horinouchi', 'Horoyuki Hashimoto', 'Reiji Hirano', 'Natsuho Futakuchi', 'Akira Sato']
+        name_list = NAME_LIST
         for name in name_list:
             if prob < random.random():
                 enter_name_list.append(name)
@@ -421,8 +887,9 @@ def ai_mode(eng):
     #    return 'kansai'
     #return ''
 
-def enter_message():
-    now = datetime.datetime.now()
+def enter_message(now = None):
+    if now is None:
+        now = datetime.datetime.now()
     if now.hour < 11:
         return 'おはようございます'
     if now.hour < 17:
@@ -488,18 +955,26 @@ def TimeSignal():
         time.sleep(60)
 
 def Mainloop():
-    print('pid:' + str(os.getpid()))
+    logger.info('event=start pid=%d', os.getpid())
     #print("Ctrl+Cで終了します")
 
     k = klab()
     #asyncio.create_task(TimeSignal())
+    first_poll = True
     while True:
         enter = []
         exit = []
         try:
             (enter, exit) = k.check()
         except Exception as e:
-            print(e)
+            metrics.inc("klab_errors_total", stage="poll")
+            logger.warning('event=poll_failed error="%s"', e)
+
+        if first_poll:
+            first_poll = False
+            startup = time.perf_counter() - _t_start
+            metrics.set_gauge("klab_startup_seconds", startup)
+            logger.info('event=first_poll startup_sec=%.3f', startup)
 
         num_event = len(enter) + len(exit)
         if num_event < 1:
@@ -507,24 +982,45 @@ def Mainloop():
             #print('.', end='')
             continue
 
-        print('%d events' % num_event)
+        Announce(enter, exit, time.perf_counter(), on_announced=k.mark_announced)
 
-        for name in enter:
-            jpn_name = convert_eng2jpn_name(name)
-            mode = ai_mode(name)
-            message = enter_message()
-            Talk_Sentence([jpn_name, message], mode)
-            time.sleep(1)
+# 入室者と退出者を順にアナウンスします
+# t_event はイベントを検出した時刻 (time.perf_counter) です
+# on_audio(name, kind) は各アナウンスの音声が出始める直前に呼ばれます
+# now を渡すと挨拶をその時刻に合わせます (リプレイ用)
+# on_announced(name, kind) は各アナウンスが終わった後に呼ばれます
+def Announce(enter, exit, t_event, on_audio = None, now = None, on_announced = None):
+    metrics.inc("klab_events_total", len(enter), kind="enter")
+    metrics.inc("klab_events_total", len(exit), kind="exit")
+    logger.info('event=detected enter=%d exit=%d', len(enter), len(exit))
 
-        for name in exit:
-            jpn_name = convert_eng2jpn_name(name)
-            mode = ai_mode(name)
-            message = 'お疲れ様でした'
-            Talk_Sentence([jpn_name, message], mode)
-            time.sleep(1)
+    for name in enter:
+        metrics.observe("klab_queue_wait_seconds", time.perf_counter() - t_event)
+        jpn_name = convert_eng2jpn_name(name)
+        mode = ai_mode(name)
+        message = enter_message(now)
+        logger.info('event=announce kind=enter name="%s"', name)
+        Talk_Announcement(jpn_name, message, mode, t_event, _bind_on_audio(on_audio, name, 'enter'))
+        if on_announced is not None:
+            on_announced(name, 'enter')
+
+    for name in exit:
+        metrics.observe("klab_queue_wait_seconds", time.perf_counter() - t_event)
+        jpn_name = convert_eng2jpn_name(name)
+        mode = ai_mode(name)
+        message = 'お疲れ様でした'
+        logger.info('event=announce kind=exit name="%s"', name)
+        Talk_Announcement(jpn_name, message, mode, t_event, _bind_on_audio(on_audio, name, 'exit'))
+        if on_announced is not None:
+            on_announced(name, 'exit')
+
+def _bind_on_audio(on_audio, name, kind):
+    if on_audio is None:
+        return None
+    return lambda: on_audio(name, kind)
 
 def PrepareEssential():
-    name_list = ['Reiko Kuwano', 'Masahide Otsubo', 'Makoto Kuno', 'Satoko Kichibayashi', 'Eiko Yoshimoto', 'Itsuki Sato', 'Chitravel Sanjei', 'Li Yang', 'Liu Junming', 'Naqi Ali', 'Daichi Yokoyama', 'Yohei Karasaki', 'Chhoeur Pryalen', 'Yutaro Hara', 'Koki Horinouchi', 'Horoyuki Hashimoto', 'Reiji Hirano', 'Natsuho Futakuchi', 'Akira Sato']
+    name_list = NAME_LIST
     for name in name_list:
         jpn_name = convert_eng2jpn_name(name)
         Prepare(jpn_name)
@@ -532,7 +1028,49 @@ def PrepareEssential():
     for word in word_list:
         Prepare(word)
 
+# 全員分の「名前 + 挨拶」を事前に作成します
+# 部品の音声が変わっていないものは読み込むだけです
+# name_list を省略するとデータベースの有効なメンバー全員分を作ります
+def RenderAnnouncements(name_list = None):
+    if name_list is None:
+        try:
+            name_list = Database().get_name_list()
+        except Exception as e:
+            logger.warning('event=name_list_failed error="%s"', e)
+            name_list = NAME_LIST
+    message_list = ['おはようございます', 'こんにちは', 'こんばんは', 'お疲れ様でした']
+    built = 0
+    with metrics.timed("klab_render_seconds"):
+        for name in name_list:
+            jpn_name = convert_eng2jpn_name(name)
+            if not jpn_name:
+                continue
+            cache = get_composite_cache(ai_mode(name))
+            for message in message_list:
+                try:
+                    if cache.build([jpn_name, message]):
+                        built += 1
+                except Exception as e:
+                    metrics.inc("klab_errors_total", stage="render")
+                    logger.warning('event=render_failed name="%s" error="%s"', name, e)
+    logger.info('event=rendered built=%d', built)
+
+def _prepare():
+    PrepareEssential()
+    RenderAnnouncements()
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sink', choices=sorted(audio_sink.SINKS), default=AUDIO_SINK)
+    args = parser.parse_args()
+    set_sink(args.sink)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s level=%(levelname)s logger=%(name)s %(message)s')
+    try:
+        metrics.serve(metrics.METRICS_PORT)
+    except OSError as e:
+        # ポートが使用中でもアナウンスは続ける
+        logger.warning('event=metrics_serve_failed port=%d error="%s"', metrics.METRICS_PORT, e)
     Talk_Sentence(['ボイスAIを起動します。'])
-    PrepareEssential()
+    # 音声の事前生成はポーリングと並行して行う
+    threading.Thread(target=_prepare, daemon=True).start()
     Mainloop()
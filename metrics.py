@@ -0,0 +1,151 @@
+import time
+import threading
+import contextlib
+import http.server
+
+# 計測値を保持して Prometheus のテキスト形式で公開します
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9105
+
+# 秒単位のヒストグラムの境界
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_gauges = {}
+_help = {}
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra = None):
+    items = list(key)
+    if extra:
+        items += extra
+    if not items:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for (k, v) in items) + '}'
+
+def describe(name, text):
+    _help[name] = text
+
+def observe(name, value, **labels):
+    key = _label_key(labels)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        h = series.get(key)
+        if h is None:
+            h = {"buckets": [0] * len(DEFAULT_BUCKETS), "sum": 0.0, "count": 0}
+            series[key] = h
+        for (i, bound) in enumerate(DEFAULT_BUCKETS):
+            if value <= bound:
+                h["buckets"][i] += 1
+        h["sum"] += value
+        h["count"] += 1
+
+def inc(name, value = 1, **labels):
+    key = _label_key(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+def set_gauge(name, value, **labels):
+    key = _label_key(labels)
+    with _lock:
+        _gauges.setdefault(name, {})[key] = value
+
+def get_counter(name, **labels):
+    with _lock:
+        return _counters.get(name, {}).get(_label_key(labels), 0)
+
+def get_histogram(name, **labels):
+    with _lock:
+        h = _histograms.get(name, {}).get(_label_key(labels))
+        if h is None:
+            return (0, 0.0)
+        return (h["count"], h["sum"])
+
+# with timed('xxx_seconds'): の形で処理時間を計測します
+# ブロック内で labels を書き換えるとラベルを後から決められます
+@contextlib.contextmanager
+def timed(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield labels
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _gauges.clear()
+
+def render():
+    lines = []
+    with _lock:
+        for name in sorted(_counters):
+            if name in _help:
+                lines.append('# HELP %s %s' % (name, _help[name]))
+            lines.append('# TYPE %s counter' % name)
+            for (key, value) in sorted(_counters[name].items()):
+                lines.append('%s%s %s' % (name, _format_labels(key), value))
+        for name in sorted(_gauges):
+            if name in _help:
+                lines.append('# HELP %s %s' % (name, _help[name]))
+            lines.append('# TYPE %s gauge' % name)
+            for (key, value) in sorted(_gauges[name].items()):
+                lines.append('%s%s %s' % (name, _format_labels(key), value))
+        for name in sorted(_histograms):
+            if name in _help:
+                lines.append('# HELP %s %s' % (name, _help[name]))
+            lines.append('# TYPE %s histogram' % name)
+            for (key, h) in sorted(_histograms[name].items()):
+                for (bound, count) in zip(DEFAULT_BUCKETS, h["buckets"]):
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(key, [("le", bound)]), count))
+                lines.append('%s_bucket%s %d' % (name, _format_labels(key, [("le", "+Inf")]), h["count"]))
+                lines.append('%s_sum%s %f' % (name, _format_labels(key), h["sum"]))
+                lines.append('%s_count%s %d' % (name, _format_labels(key), h["count"]))
+    return '\n'.join(lines) + '\n'
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# 別スレッドで /metrics を公開します
+def serve(port = METRICS_PORT, host = METRICS_HOST):
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+describe("klab_db_poll_seconds", "Time spent in one klab.check() database poll")
+describe("klab_pool_checkout_seconds", "Time waiting for a database connection")
+describe("klab_cache_lookup_seconds", "Clip cache lookup time by result")
+describe("klab_engine_request_seconds", "Voice engine round trip time by endpoint")
+describe("klab_decode_seconds", "WAV decode and trim time by engine")
+describe("klab_queue_wait_seconds", "Time from event detection to start of its announcement")
+describe("klab_first_audio_seconds", "Time from event detection to first audio handed to the output")
+describe("klab_pool_size", "Open database connections")
+describe("klab_startup_seconds", "Time from process start to the first poll")
+describe("klab_resample_seconds", "Time to convert a clip to the output rate (stage=play when the device rate differs from OUTPUT_FS)")
+describe("klab_render_seconds", "Time to render all composite announcements")
+describe("klab_cache_hits_total", "Clip cache hits")
+describe("klab_cache_misses_total", "Clip cache misses")
+describe("klab_composite_hits_total", "Announcements played from a pre-rendered composite")
+describe("klab_composite_misses_total", "Announcements assembled from parts because no composite was ready")
+describe("klab_errors_total", "Errors by stage")
+describe("klab_events_total", "Enter and exit events detected")
@@ -0,0 +1,43 @@
+import math
+import numpy
+
+# FFT でサンプリング周波数を変換します
+# 帯域外の成分は周波数領域で切り捨てるので、そのままダウンサンプリングにも使えます
+
+# 前後に足す無音 (秒)。FFT の循環で端の音が反対側に回り込むのを防ぐ
+_PAD_SEC = 0.02
+
+def resample(wav, fs_from, fs_to):
+    if fs_from == fs_to or len(wav) == 0:
+        return wav
+    g = math.gcd(int(fs_from), int(fs_to))
+    down = int(fs_from) // g
+    up = int(fs_to) // g
+
+    x = numpy.asarray(wav, dtype=numpy.float64)
+    pad = int(fs_from * _PAD_SEC)
+    # 入力長を down の倍数にすると出力長がちょうど整数になる
+    n_in = -(-(len(x) + 2 * pad) // down) * down
+    n_out = n_in // down * up
+    padded = numpy.zeros(n_in)
+    padded[pad:pad + len(x)] = x
+
+    spec = numpy.fft.rfft(padded)
+    n_bins = n_out // 2 + 1
+    if n_bins <= len(spec):
+        spec = spec[:n_bins].copy()
+    else:
+        spec = numpy.concatenate([spec, numpy.zeros(n_bins - len(spec), dtype=spec.dtype)])
+    # 短い方の長さのナイキスト成分は正負の周波数で分け合う (scipy.signal.resample と同じ扱い)
+    n = min(n_in, n_out)
+    if n % 2 == 0:
+        spec[n // 2] *= 2.0 if n_out < n_in else 0.5
+    y = numpy.fft.irfft(spec, n_out) * (n_out / n_in)
+
+    start = pad * up // down
+    length = len(x) * up // down
+    y = y[start:start + length]
+    if numpy.issubdtype(numpy.asarray(wav).dtype, numpy.integer):
+        info = numpy.iinfo(numpy.asarray(wav).dtype)
+        y = numpy.clip(numpy.round(y), info.min, info.max).astype(numpy.asarray(wav).dtype)
+    return y